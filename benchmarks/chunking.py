@@ -0,0 +1,82 @@
+"""Storage savings and throughput of chunked blobs.
+
+Commits a large binary file, then a few versions of it with small edits,
+once with chunking disabled and once enabled. Reports the object store size
+and the add and checkout throughput of each.
+
+Usage: python benchmarks/chunking.py [--size MB] [--versions N]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from ugit import base, data  # noqa: E402
+
+
+def _store_size(repo: str) -> int:
+    objects = f"{repo}/.ugit/objects"
+    return sum(os.path.getsize(f"{objects}/{name}") for name in os.listdir(objects))
+
+
+def run(chunk_threshold, size: int, versions: int) -> dict:
+    rng = random.Random(0)
+    content = bytearray(rng.randbytes(size))
+    add_time = checkout_time = 0.0
+    with tempfile.TemporaryDirectory() as repo:
+        cwd = os.getcwd()
+        os.chdir(repo)
+        try:
+            with data.change_git_dir("."):
+                base.init(chunk_threshold)
+                commits = []
+                for i in range(versions):
+                    if i:
+                        # A small insertion somewhere in the file
+                        at = rng.randrange(len(content))
+                        content[at:at] = rng.randbytes(16)
+                    with open("data.bin", "wb") as f:
+                        f.write(content)
+                    start = time.perf_counter()
+                    base.add(["data.bin"])
+                    add_time += time.perf_counter() - start
+                    commits.append(base.commit(f"version {i}"))
+
+                for oid in commits:
+                    start = time.perf_counter()
+                    base.checkout(oid)
+                    checkout_time += time.perf_counter() - start
+            store = _store_size(repo)
+        finally:
+            os.chdir(cwd)
+
+    total = size * versions / 2**20
+    return {
+        "store_mb": store / 2**20,
+        "add_mb_s": total / add_time,
+        "checkout_mb_s": total / checkout_time,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=16, help="file size in MiB")
+    parser.add_argument("--versions", type=int, default=5)
+    args = parser.parse_args()
+    os.environ.setdefault("UGIT_FSYNC", "none")
+
+    size = args.size * 2**20
+    print(f"{args.versions} versions of a {args.size} MiB file")
+    for label, threshold in (("whole", None), ("chunked", 1024 * 1024)):
+        result = run(threshold, size, args.versions)
+        print(f"{label:>8}: store {result['store_mb']:8.1f} MiB, "
+              f"add {result['add_mb_s']:6.1f} MiB/s, "
+              f"checkout {result['checkout_mb_s']:6.1f} MiB/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""Commit throughput under each fsync policy.
+
+Usage: python benchmarks/commit_throughput.py [-n COMMITS] [-f FILES]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from ugit import base, data  # noqa: E402
+
+
+def run(policy: str, commits: int, files: int) -> float:
+    os.environ["UGIT_FSYNC"] = policy
+    with tempfile.TemporaryDirectory() as repo:
+        cwd = os.getcwd()
+        os.chdir(repo)
+        try:
+            with data.change_git_dir("."):
+                base.init()
+                start = time.perf_counter()
+                for i in range(commits):
+                    for j in range(files):
+                        with open(f"file{j}", "w") as f:
+                            f.write(f"commit {i} file {j}\n")
+                    base.add(["."])
+                    base.commit(f"commit {i}")
+                return time.perf_counter() - start
+        finally:
+            os.chdir(cwd)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--commits", type=int, default=200)
+    parser.add_argument("-f", "--files", type=int, default=10)
+    args = parser.parse_args()
+
+    for policy in data.FSYNC_POLICIES:
+        elapsed = run(policy, args.commits, args.files)
+        print(f"{policy:>8}: {args.commits / elapsed:8.1f} commits/s ({elapsed:.2f}s)")
+
+
+if __name__ == "__main__":
+    main()
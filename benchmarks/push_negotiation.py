@@ -0,0 +1,89 @@
+"""Pushing a single commit onto a long history.
+
+Builds a linear history of --commits commits, copies it as the remote, adds
+one commit locally and times the push. With --full-walk it also times the
+old way of finding the objects to push: enumerating everything reachable on
+both sides and subtracting.
+
+Usage: python benchmarks/push_negotiation.py [--commits N] [--full-walk]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from ugit import base, data, remote  # noqa: E402
+
+
+def build_history(commits: int) -> str:
+    # Each commit changes one file in one of 16 directories, written straight
+    # to the object store to keep setup fast
+    static = data.hash_object(b"".join(
+        f"blob {data.hash_object(f'static {i}'.encode())} s{i}\n".encode()
+        for i in range(16)
+    ), "tree")
+    dirs = {f"d{i}": static for i in range(16)}
+    parent = None
+    for i in range(commits):
+        name = f"d{i % 16}"
+        blob = data.hash_object(f"commit {i}\n".encode())
+        dirs[name] = data.hash_object(f"blob {blob} counter\n".encode(), "tree")
+        tree = data.hash_object("".join(
+            f"tree {oid} {dirname}\n" for dirname, oid in sorted(dirs.items())
+        ).encode(), "tree")
+        commit = f"tree {tree}\n"
+        if parent:
+            commit += f"parent {parent}\n"
+        parent = data.hash_object(f"{commit}\ncommit {i}\n".encode(), "commit")
+    data.update_ref("refs/heads/master", data.RefValue(symbolic=False, value=parent))
+    return parent
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--commits", type=int, default=100_000)
+    parser.add_argument("--full-walk", action="store_true")
+    args = parser.parse_args()
+    os.environ.setdefault("UGIT_FSYNC", "none")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        local, server = f"{tmp}/local", f"{tmp}/server"
+        os.makedirs(local)
+        cwd = os.getcwd()
+        os.chdir(local)
+        try:
+            with data.change_git_dir("."):
+                start = time.perf_counter()
+                base.init()
+                tip = build_history(args.commits)
+                print(f"built {args.commits} commits in {time.perf_counter() - start:.1f}s")
+
+                # Objects are immutable, so the server can share them
+                shutil.copytree(local, server, copy_function=os.link)
+
+                base.checkout("master")
+                with open("new-file", "w") as f:
+                    f.write("one more commit\n")
+                base.add(["new-file"])
+                base.commit("one more commit")
+
+                start = time.perf_counter()
+                remote.push(server, "refs/heads/master")
+                print(f"push of 1 commit: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+                if args.full_walk:
+                    start = time.perf_counter()
+                    ours = set(base.iter_objects_in_commits({base.get_oid("master")}))
+                    theirs = set(base.iter_objects_in_commits({tip}))
+                    assert len(ours - theirs) == 3
+                    print(f"full walk: {(time.perf_counter() - start) * 1000:.1f} ms")
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    main()
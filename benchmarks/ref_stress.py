@@ -0,0 +1,124 @@
+"""Many processes racing to advance the same branch.
+
+Two rounds, each checking that the branch history ends up with every commit
+a writer reported as successful:
+
+- committers share one repository and run base.commit(), which updates the
+  branch with a compare-and-swap, retrying on conflicts
+- pushers each commit in their own clone and push to one shared remote with
+  remote.push(), fetching and committing again when someone else pushed first
+
+Usage: python benchmarks/ref_stress.py [-w WRITERS] [-n COMMITS_PER_WRITER]
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from ugit import base, data, remote  # noqa: E402
+
+BRANCH = "refs/heads/master"
+
+# Ways a racing update fails: a compare-and-swap that lost, a lockfile held
+# too long, or a push that is no longer a fast-forward
+RACE_ERRORS = (data.RefConflictError, data.LockError, AssertionError)
+
+
+def committer(repo: str, writer_id: int, commits: int) -> tuple[list[str], int]:
+    os.environ["UGIT_FSYNC"] = "none"
+    written = []
+    conflicts = 0
+    with data.change_git_dir(repo):
+        for i in range(commits):
+            while True:
+                try:
+                    written.append(base.commit(f"writer {writer_id} commit {i}"))
+                    break
+                except RACE_ERRORS:
+                    conflicts += 1
+    return written, conflicts
+
+
+def pusher(origin: str, clone: str, writer_id: int, commits: int) -> tuple[list[str], int]:
+    os.environ["UGIT_FSYNC"] = "none"
+    os.makedirs(clone)
+    os.chdir(clone)
+    pushed = []
+    conflicts = 0
+    with data.change_git_dir(clone):
+        base.init()
+        for i in range(commits):
+            while True:
+                # Start over from whatever the remote has now
+                remote.fetch(origin)
+                tip = base.get_oid("remote/master")
+                base.reset(tip)
+                base.read_tree(base.get_commit(tip).tree)
+
+                with open(f"writer{writer_id}", "a") as f:
+                    f.write(f"commit {i}\n")
+                base.add([f"writer{writer_id}"])
+                oid = base.commit(f"writer {writer_id} commit {i}")
+                try:
+                    remote.push(origin, BRANCH)
+                    pushed.append(oid)
+                    break
+                except RACE_ERRORS:
+                    conflicts += 1
+    return pushed, conflicts
+
+
+def check(name: str, repo: str, results: list, elapsed: float, writers: int) -> bool:
+    with data.change_git_dir(repo):
+        history = set(base.iter_commits_and_parents({data.get_ref(BRANCH).value}))
+
+    reported = [oid for oids, _ in results for oid in oids]
+    conflicts = sum(conflicts for _, conflicts in results)
+    lost = [oid for oid in reported if oid not in history]
+    print(f"{name}: {len(reported)} commits by {writers} writers in {elapsed:.2f}s, "
+          f"{conflicts} retries, branch history has {len(history)} commits")
+    if lost:
+        print(f"{name}: LOST {len(lost)} COMMITS")
+    return not lost
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-w", "--writers", type=int, default=8)
+    parser.add_argument("-n", "--commits", type=int, default=100)
+    args = parser.parse_args()
+
+    ok = True
+    with tempfile.TemporaryDirectory() as tmp:
+        repo = f"{tmp}/shared"
+        os.makedirs(repo)
+        with data.change_git_dir(repo):
+            base.init()
+
+        start = time.perf_counter()
+        with multiprocessing.Pool(args.writers) as pool:
+            results = pool.starmap(
+                committer, [(repo, i, args.commits) for i in range(args.writers)]
+            )
+        ok &= check("commit", repo, results, time.perf_counter() - start, args.writers)
+
+        # The shared repository, with its history, is the remote everyone
+        # pushes to
+        start = time.perf_counter()
+        with multiprocessing.Pool(args.writers) as pool:
+            results = pool.starmap(
+                pusher,
+                [(repo, f"{tmp}/clone{i}", i, args.commits) for i in range(args.writers)],
+            )
+        ok &= check("push", repo, results, time.perf_counter() - start, args.writers)
+
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+"""Benchmark harness for the ugit commands.
+
+Generates a synthetic repository (see synth.py), then times each scenario
+against a fresh copy of it by running the real CLI in a subprocess. For every
+scenario it records the wall time, peak RSS, block I/O and context switches
+of that process, plus the ugit trace counters (objects read and written, refs,
+tree walks, subprocesses...). Results are written as JSON. Pass an earlier
+results file as --compare to flag regressions.
+
+Usage:
+    python benchmarks/run.py -o results.json [--repeat N] [shape options]
+    python benchmarks/run.py -o new.json --compare results.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import synth
+
+SRC_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+
+# Relative slowdown (or counter growth) reported as a regression
+DEFAULT_THRESHOLD = 0.10
+# Wall times below this are too noisy to compare
+MIN_COMPARABLE_SECONDS = 0.05
+
+
+def ugit(cwd: str, *args: str, measure=False) -> dict:
+    env = dict(os.environ, PYTHONPATH=SRC_DIR, UGIT_FSYNC="none")
+    trace_file = None
+    if measure:
+        fd, trace_file = tempfile.mkstemp(suffix=".json")
+        os.close(fd)
+        env["UGIT_TRACE"] = trace_file
+
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "ugit", *args],
+        cwd=cwd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+    )
+    _, status, rusage = os.wait4(proc.pid, 0)
+    elapsed = time.perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    stderr = proc.stderr.read().decode()
+    proc.stderr.close()
+    if proc.returncode != 0:
+        raise RuntimeError(f"ugit {' '.join(args)} failed:\n{stderr}")
+    if not measure:
+        return {}
+
+    with open(trace_file) as f:
+        counters = json.load(f)["otherData"]["counters"]
+    os.remove(trace_file)
+    return {
+        "wall_s": elapsed,
+        "max_rss_kb": rusage.ru_maxrss,
+        "blocks_in": rusage.ru_inblock,
+        "blocks_out": rusage.ru_oublock,
+        "context_switches": rusage.ru_nvcsw + rusage.ru_nivcsw,
+        "counters": counters,
+    }
+
+
+def _modify(repo: str, count: int) -> None:
+    paths = sorted(synth.file_paths(SHAPE))[:count]
+    for path in paths:
+        with open(os.path.join(repo, path), "ab") as f:
+            f.write(b"benchmark change\n")
+
+
+# Each scenario gets a scratch directory holding a fresh copy of the
+# repository at "repo", prepares it and returns the measured command.
+
+def scenario_add(tmp: str):
+    _modify(f"{tmp}/repo", 20)
+    return f"{tmp}/repo", ["add", "."]
+
+
+def scenario_commit(tmp: str):
+    _modify(f"{tmp}/repo", 20)
+    ugit(f"{tmp}/repo", "add", ".")
+    return f"{tmp}/repo", ["commit", "-m", "benchmark"]
+
+
+def scenario_status(tmp: str):
+    _modify(f"{tmp}/repo", 20)
+    return f"{tmp}/repo", ["status"]
+
+
+def scenario_checkout(tmp: str):
+    ugit(f"{tmp}/repo", "branch", "bench-base", "master")
+    _modify(f"{tmp}/repo", 20)
+    ugit(f"{tmp}/repo", "add", ".")
+    ugit(f"{tmp}/repo", "commit", "-m", "benchmark")
+    return f"{tmp}/repo", ["checkout", "bench-base"]
+
+
+def scenario_merge(tmp: str):
+    repo = f"{tmp}/repo"
+    ugit(repo, "branch", "bench-side", "master")
+    ugit(repo, "checkout", "bench-side")
+    _modify(repo, 10)
+    ugit(repo, "add", ".")
+    ugit(repo, "commit", "-m", "side")
+    ugit(repo, "checkout", "master")
+    with open(f"{repo}/bench-master.txt", "w") as f:
+        f.write("master\n")
+    ugit(repo, "add", "bench-master.txt")
+    ugit(repo, "commit", "-m", "master")
+    return repo, ["merge", "bench-side"]
+
+
+def scenario_log(tmp: str):
+    return f"{tmp}/repo", ["log"]
+
+
+def scenario_fetch(tmp: str):
+    os.makedirs(f"{tmp}/clone")
+    ugit(f"{tmp}/clone", "init")
+    return f"{tmp}/clone", ["fetch", "../repo"]
+
+
+def scenario_push(tmp: str):
+    clone = f"{tmp}/clone"
+    shutil.copytree(f"{tmp}/repo", clone)
+    _modify(clone, 10)
+    ugit(clone, "add", ".")
+    ugit(clone, "commit", "-m", "benchmark")
+    return clone, ["push", "../repo", "master"]
+
+
+SCENARIOS = {
+    name[len("scenario_"):]: func
+    for name, func in globals().items()
+    if name.startswith("scenario_")
+}
+
+SHAPE = synth.Shape()
+
+
+def run(fixture: str, names: list[str], repeat: int) -> dict:
+    results = {}
+    for name in names:
+        runs = []
+        for _ in range(repeat):
+            with tempfile.TemporaryDirectory() as tmp:
+                shutil.copytree(fixture, f"{tmp}/repo")
+                cwd, args = SCENARIOS[name](tmp)
+                runs.append(ugit(cwd, *args, measure=True))
+        best = min(runs, key=lambda r: r["wall_s"])
+        results[name] = dict(
+            best,
+            wall_s=statistics.median(r["wall_s"] for r in runs),
+            wall_s_min=best["wall_s"],
+            max_rss_kb=max(r["max_rss_kb"] for r in runs),
+        )
+        print(f"{name:>10}: {results[name]['wall_s'] * 1000:9.1f} ms "
+              f"{results[name]['max_rss_kb']:>8} KiB", file=sys.stderr)
+    return results
+
+
+def compare(old: dict, new: dict, threshold: float) -> list[str]:
+    regressions = []
+    for name, result in new["results"].items():
+        before = old["results"].get(name)
+        if not before:
+            continue
+        if (
+            before["wall_s"] >= MIN_COMPARABLE_SECONDS
+            and result["wall_s"] > before["wall_s"] * (1 + threshold)
+        ):
+            regressions.append(
+                f"{name}: wall time {before['wall_s']:.3f}s -> {result['wall_s']:.3f}s"
+            )
+        for counter, value in result["counters"].items():
+            previous = before["counters"].get(counter, 0)
+            if value > previous * (1 + threshold) and value - previous > 1:
+                regressions.append(f"{name}: {counter} {previous} -> {value}")
+    return regressions
+
+
+def main() -> None:
+    global SHAPE
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", "--output", help="write results JSON here")
+    parser.add_argument("--compare", metavar="RESULTS", help="earlier results JSON")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS))
+    synth.add_arguments(parser)
+    args = parser.parse_args()
+
+    os.environ.setdefault("UGIT_FSYNC", "none")
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        # Runs are only comparable on the same repository
+        SHAPE = synth.Shape(**baseline["shape"])
+    else:
+        SHAPE = synth.shape_from_args(args)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        fixture = f"{tmp}/fixture"
+        start = time.perf_counter()
+        synth.generate(fixture, SHAPE)
+        print(f"generated {SHAPE} in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+        results = {
+            "shape": SHAPE._asdict(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": time.time(),
+            "results": run(fixture, args.scenario or list(SCENARIOS), args.repeat),
+        }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+
+    if baseline:
+        regressions = compare(baseline, results, args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
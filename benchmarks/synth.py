@@ -0,0 +1,131 @@
+"""Synthetic repository generator.
+
+Builds a ugit repository with a configurable shape: number and size of files,
+directory depth, history length and how often history merges. The same
+parameters and seed always produce the same repository.
+
+Usage: python benchmarks/synth.py DIR [--files N] [--file-size BYTES] ...
+"""
+import argparse
+import contextlib
+import io
+import os
+import random
+import sys
+from typing import NamedTuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from ugit import base, data  # noqa: E402
+
+
+class Shape(NamedTuple):
+    files: int = 200
+    file_size: int = 1024
+    depth: int = 3
+    commits: int = 50
+    # Fraction of commits that are merges of a short-lived side branch
+    merge_density: float = 0.1
+    # Fraction of the files touched by each commit
+    churn: float = 0.05
+    seed: int = 0
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    defaults = Shape()
+    parser.add_argument("--files", type=int, default=defaults.files)
+    parser.add_argument("--file-size", type=int, default=defaults.file_size)
+    parser.add_argument("--depth", type=int, default=defaults.depth)
+    parser.add_argument("--commits", type=int, default=defaults.commits)
+    parser.add_argument("--merge-density", type=float, default=defaults.merge_density)
+    parser.add_argument("--churn", type=float, default=defaults.churn)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+
+
+def shape_from_args(args: argparse.Namespace) -> Shape:
+    return Shape(**{field: getattr(args, field) for field in Shape._fields})
+
+
+def file_paths(shape: Shape) -> list[str]:
+    rng = random.Random(shape.seed)
+    paths = []
+    for i in range(shape.files):
+        dirs = [f"d{rng.randrange(4)}" for _ in range(rng.randint(0, shape.depth))]
+        paths.append("/".join(dirs + [f"f{i}.txt"]))
+    return paths
+
+
+def _content(rng: random.Random, size: int) -> bytes:
+    # Line-oriented, so diff and diff3 have something sensible to chew on
+    line = 63
+    lines = [
+        "".join(rng.choice("abcdefghijklmnopqrstuvwxyz ") for _ in range(line))
+        for _ in range(max(1, size // (line + 1)))
+    ]
+    return ("\n".join(lines) + "\n").encode()
+
+
+def _write(path: str, content: bytes) -> None:
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(content)
+
+
+def _touch_some(rng: random.Random, shape: Shape, paths: list[str], tag: str) -> None:
+    count = max(1, int(len(paths) * shape.churn))
+    for path in rng.sample(paths, min(count, len(paths))):
+        with open(path, "ab") as f:
+            f.write(f"{tag}\n".encode())
+
+
+def generate(path: str, shape: Shape) -> None:
+    rng = random.Random(shape.seed)
+    paths = file_paths(shape)
+    os.makedirs(path)
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        # base.merge() reports to stdout, keep that out of benchmark output
+        with data.change_git_dir("."), contextlib.redirect_stdout(io.StringIO()):
+            base.init()
+            for file_path in paths:
+                _write(file_path, _content(rng, shape.file_size))
+            base.add(["."])
+            base.commit("initial")
+
+            side = 0
+            for i in range(1, shape.commits):
+                if rng.random() < shape.merge_density:
+                    side += 1
+                    branch = f"side{side}"
+                    base.create_branch(branch, base.get_oid("@"))
+                    base.checkout(branch)
+                    _touch_some(rng, shape, paths, f"{branch} change")
+                    base.add(["."])
+                    base.commit(f"commit {i} on {branch}")
+                    base.checkout("master")
+                    _touch_some(rng, shape, paths, f"master change {i}")
+                    base.add(["."])
+                    base.commit(f"commit {i}")
+                    base.merge(base.get_oid(branch))
+                    base.commit(f"merge {branch}")
+                else:
+                    _touch_some(rng, shape, paths, f"change {i}")
+                    base.add(["."])
+                    base.commit(f"commit {i}")
+    finally:
+        os.chdir(cwd)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path")
+    add_arguments(parser)
+    args = parser.parse_args()
+    generate(args.path, shape_from_args(args))
+
+
+if __name__ == "__main__":
+    main()
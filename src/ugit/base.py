@@ -7,26 +7,27 @@ from collections import deque, namedtuple
 
 from . import data
 from . import diff
+from . import trace
 
 
-def init():
-    data.init()
+def init(chunk_threshold: int = None):
+    data.init(chunk_threshold)
     data.update_ref("HEAD", data.RefValue(symbolic=True, value="refs/heads/master"))
 
 
+@trace.traced("tree.write")
 def write_tree() -> None:
     # Index is flat, we neet it as a tree of dicts
     index_as_tree = {}
-    with data.get_index() as index:
-        for path, oid in index.items():
-            path = path.split("/")
-            dirpath, filename = path[:-1], path[-1]
+    for path, oid in data.read_index().items():
+        path = path.split("/")
+        dirpath, filename = path[:-1], path[-1]
 
-            current = index_as_tree
-            # Find the dict for the directory of this file
-            for dirname in dirpath:
-                current = current.setdefault(dirname, {})
-            current[filename] = oid
+        current = index_as_tree
+        # Find the dict for the directory of this file
+        for dirname in dirpath:
+            current = current.setdefault(dirname, {})
+        current[filename] = oid
 
     def write_tree_recursive(tree_dict: dict):
         entries = []
@@ -55,6 +56,7 @@ def read_tree_merged(t_base: dict, t_HEAD: dict, t_other: dict) -> None:
             f.write(blob)
 
 
+@trace.traced("commit")
 def commit(message: str) -> str:
     commit = f"tree {write_tree()}\n"
 
@@ -64,18 +66,30 @@ def commit(message: str) -> str:
     MERGE_HEAD = data.get_ref("MERGE_HEAD").value
     if MERGE_HEAD:
         commit += f"parent {MERGE_HEAD}\n"
-        data.delete_ref("MERGE_HEAD", deref=False)
 
     commit += "\n"
     commit += f"{message}\n"
 
     oid = data.hash_object(commit.encode(), "commit")
 
-    data.update_ref(ref="HEAD", value=data.RefValue(symbolic=False, value=oid))
+    # Fail instead of dropping whatever was committed since we read HEAD
+    with data.ref_transaction() as transaction:
+        transaction.update(
+            "HEAD",
+            data.RefValue(symbolic=False, value=oid),
+            old=data.RefValue(symbolic=False, value=HEAD),
+        )
+        if MERGE_HEAD:
+            transaction.delete(
+                "MERGE_HEAD",
+                deref=False,
+                old=data.RefValue(symbolic=False, value=MERGE_HEAD),
+            )
 
     return oid
 
 
+@trace.traced("checkout")
 def checkout(name: str) -> None:
     oid = get_oid(name)
     commit = get_commit(oid)
@@ -93,6 +107,7 @@ def reset(oid: str) -> None:
     data.update_ref("HEAD", data.RefValue(symbolic=False, value=oid))
 
 
+@trace.traced("merge")
 def merge(other: str):
     HEAD = data.get_ref("HEAD").value
     assert HEAD
@@ -101,12 +116,23 @@ def merge(other: str):
 
     # Handle fast-forward merge
     if merge_base == HEAD:
+        # Move HEAD first: if it changed meanwhile this fails before the
+        # index and working tree are touched
+        data.update_ref(
+            "HEAD",
+            data.RefValue(symbolic=False, value=other),
+            old=data.RefValue(symbolic=False, value=HEAD),
+        )
         read_tree(c_other.tree, update_working=True)
-        data.update_ref("HEAD", data.RefValue(symbolic=False, value=other))
         print("Fast-forward merge, no need to commit")
         return
 
-    data.update_ref("MERGE_HEAD", data.RefValue(symbolic=False, value=other))
+    data.update_ref(
+        "MERGE_HEAD",
+        data.RefValue(symbolic=False, value=other),
+        deref=False,
+        old=data.MISSING_REF,
+    )
 
     c_base = get_commit(merge_base)
     c_HEAD = get_commit(HEAD)
@@ -115,6 +141,7 @@ def merge(other: str):
     print("Merged in working tree\nPlease commit")
 
 
+@trace.traced("merge_base")
 def get_merge_base(oid1: str, oid2: str) -> str | None:
     parents1 = set(iter_commits_and_parents({oid1}))
 
@@ -132,7 +159,11 @@ def create_tag(name: str, oid: str) -> None:
 
 
 def create_branch(name: str, oid: str) -> None:
-    data.update_ref(f"refs/heads/{name}", data.RefValue(symbolic=False, value=oid))
+    data.update_ref(
+        f"refs/heads/{name}",
+        data.RefValue(symbolic=False, value=oid),
+        old=data.MISSING_REF,
+    )
 
 
 def iter_branch_names():
@@ -157,8 +188,18 @@ Commit = namedtuple("Commit", ["tree", "parents", "message"])
 
 
 def get_commit(oid: str) -> Commit:
+    commit = read_commit(oid)
+    # History of a shallow clone ends at its shallow commits
+    if commit.parents and oid in data.get_shallow():
+        commit = commit._replace(parents=[])
+    return commit
+
+
+def read_commit(oid: str) -> Commit:
+    # The commit as stored, ignoring shallow boundaries
     parents = []
 
+    trace.count("commits.parsed")
     commit = data.get_object(oid, "commit").decode()
     lines = iter(commit.splitlines())
     for line in itertools.takewhile(operator.truth, lines):
@@ -174,24 +215,33 @@ def get_commit(oid: str) -> Commit:
     return Commit(tree, parents, message)
 
 
-def iter_commits_and_parents(oids):
-    oids = deque(oids)
+def iter_commits_and_parents(oids, depth: int = None):
+    # With a depth, only commits at most that many commits away from oids
+    # (the oids themselves being 1) are returned
+    oids = deque((oid, 1) for oid in oids)
     visited = set()
 
     while oids:
-        oid = oids.popleft()
+        oid, distance = oids.popleft()
         if not oid or oid in visited:
             continue
         visited.add(oid)
         yield oid
+        if depth is not None and distance >= depth:
+            continue
         commit = get_commit(oid)
-        # Return first parent next
-        oids.extendleft(commit.parents[:1])
-        # Return other parents later
-        oids.extend(commit.parents[1:])
+        parents = [(parent, distance + 1) for parent in commit.parents]
+        if depth is None:
+            # Return first parent next
+            oids.extendleft(parents[:1])
+            # Return other parents later
+            oids.extend(parents[1:])
+        else:
+            # Breadth first, so every commit is reached by its shortest path
+            oids.extend(parents)
 
 
-def iter_objects_in_commits(oids: list[str]):
+def iter_objects_in_commits(oids: list[str], depth: int = None):
     # N.B. Must yield the oid before accessing it (to allow caller to fetch it
     # if needed)
     visited = set()
@@ -206,14 +256,121 @@ def iter_objects_in_commits(oids: list[str]):
                 else:
                     visited.add(oid)
                     yield oid
-
-    for oid in iter_commits_and_parents(oids):
+                    yield from iter_objects_in_blob(oid)
+
+    def iter_objects_in_blob(oid: str):
+        # Chunked blobs also need their chunks (unless the caller decided to
+        # skip the blob, see remote.fetch())
+        if not data.object_exists(oid):
+            return
+        for chunk_oid in data.get_chunk_oids(oid):
+            if chunk_oid not in visited:
+                visited.add(chunk_oid)
+                yield chunk_oid
+
+    for oid in iter_commits_and_parents(oids, depth):
         yield oid
         commit = get_commit(oid)
         if commit.tree not in visited:
             yield from iter_objects_in_tree(commit.tree)
 
 
+def get_missing_commits(wants, has_commit, depth: int = None):
+    # Commits reachable from wants that the receiving side doesn't have,
+    # according to has_commit(oid). The walk stops at commits the receiver
+    # has, since it has their whole history too, so its cost follows the
+    # number of new commits. Returns the missing commits, parents before
+    # children, and the common commits where the walk stopped.
+    queue = deque((oid, 1) for oid in wants)
+    seen = set()
+    missing = {}
+    common = set()
+    while queue:
+        oid, distance = queue.popleft()
+        if not oid or oid in seen:
+            continue
+        seen.add(oid)
+        trace.count("negotiation.commits")
+        if has_commit(oid):
+            common.add(oid)
+            continue
+        if depth is not None and distance >= depth:
+            missing[oid] = []
+            continue
+        missing[oid] = get_commit(oid).parents
+        queue.extend((parent, distance + 1) for parent in missing[oid])
+
+    return sort_parents_first(missing), common
+
+
+def sort_parents_first(parents: dict) -> list[str]:
+    # Topological order of the commits in parents (commit -> its parents),
+    # ignoring parents that aren't keys themselves
+    ordered = []
+    done = set()
+    for oid in parents:
+        stack = [(oid, False)]
+        while stack:
+            oid, parents_done = stack.pop()
+            if parents_done:
+                ordered.append(oid)
+                continue
+            if oid in done:
+                continue
+            done.add(oid)
+            stack.append((oid, True))
+            stack.extend(
+                (parent, False) for parent in parents[oid]
+                if parent in parents and parent not in done
+            )
+    return ordered
+
+
+def iter_missing_objects(commits: list[str], common: set):
+    # All objects the receiver needs for commits (as returned by
+    # get_missing_commits()). Each tree is only compared against the trees of
+    # its parents, which the receiver has or gets as well. Commits come last,
+    # parents first, so a receiver never has a commit without its objects.
+    sent = set()
+    new_commits = set(commits)
+
+    def iter_tree(oid: str, known_oids: set):
+        if oid in sent or oid in known_oids:
+            return
+        sent.add(oid)
+        yield oid
+
+        known_entries = {}
+        for known_oid in known_oids:
+            for type_, entry_oid, name in _iter_tree_entries(known_oid):
+                known_entries.setdefault((type_, name), set()).add(entry_oid)
+
+        for type_, entry_oid, name in _iter_tree_entries(oid):
+            known = known_entries.get((type_, name), set())
+            if type_ == "tree":
+                yield from iter_tree(entry_oid, known)
+            elif entry_oid not in sent and entry_oid not in known:
+                sent.add(entry_oid)
+                yield entry_oid
+                # A blob left out by a filtered fetch would be fetched just
+                # to look for chunks
+                if not data.object_exists(entry_oid):
+                    continue
+                for chunk_oid in data.get_chunk_oids(entry_oid):
+                    if chunk_oid not in sent:
+                        sent.add(chunk_oid)
+                        yield chunk_oid
+
+    for oid in commits:
+        commit = get_commit(oid)
+        parent_trees = {
+            get_commit(parent).tree for parent in commit.parents
+            if parent in new_commits or parent in common
+        }
+        yield from iter_tree(commit.tree, parent_trees)
+    yield from commits
+
+
 def get_oid(name: str) -> str:
     if name == "@": name = "HEAD"
 
@@ -236,14 +393,13 @@ def get_oid(name: str) -> str:
     assert False, f"Unknown name {name}"
 
 
+@trace.traced("add")
 def add(filenames: list[str]) -> None:
 
     def add_file(filename) -> None:
         # Normalize path
         filename = os.path.relpath(filename)
-        with open(filename, "rb") as f:
-            oid = data.hash_object(f.read())
-        index[filename] = oid
+        index[filename] = data.hash_file(filename)
 
     def add_directory(dirname: str) -> None:
         for root, _, filenames in os.walk(dirname):
@@ -269,6 +425,7 @@ def is_ignored(path: str) -> bool:
 def _iter_tree_entries(oid: str):
     if not oid:
         return
+    trace.count("trees.read")
     tree = data.get_object(oid, "tree")
     for entry in tree.decode().splitlines():
         type_, oid, name = entry.split(" ", maxsplit=2)
@@ -290,23 +447,101 @@ def get_tree(oid: str, base_path=""):
     return result
 
 
+@trace.traced("worktree.scan")
 def get_working_tree() -> dict:
     result = {}
-    for root, _, filenames in os.walk("."):
+    patterns = data.get_sparse_patterns()
+    for root, dirnames, filenames in os.walk("."):
+        # Don't descend into directories left out of a sparse checkout
+        dirnames[:] = [
+            dirname for dirname in dirnames
+            if _is_sparse_dir(os.path.relpath(f"{root}/{dirname}"), patterns)
+        ]
         for filename in filenames:
             path = os.path.relpath(f"{root}/{filename}")
             if is_ignored(path) or not os.path.isfile(path):
                 continue
-            with open(path, "rb") as f:
-                result[path] = data.hash_object(f.read())
+            # Parents of a sparse directory are walked, but only the files
+            # sparse_tree() keeps on the index side count
+            if not is_sparse_path(path, patterns):
+                continue
+            result[path] = data.hash_file(path)
     return result
 
 
 def get_index_tree():
-    with data.get_index() as index:
-        return index
+    return data.read_index()
+
+
+# Sparse checkout works on whole directories (like git's "cone mode"): files
+# at the top level are always checked out, deeper ones only if they are under
+# one of the sparse directories. The index always keeps the full tree.
+
+def set_sparse_checkout(dirnames: list[str] | None) -> None:
+    if dirnames is not None:
+        dirnames = sorted({os.path.normpath(dirname).strip("/") for dirname in dirnames})
+        assert all(d and d != "." and not d.startswith("..") for d in dirnames)
+    index = data.read_index()
+    # Like git, refuse to drop files with changes that would be lost
+    modified = [
+        path for path, oid in index.items()
+        if not is_sparse_path(path, dirnames)
+        and os.path.isfile(path)
+        and data.hash_file(path) != oid
+    ]
+    assert not modified, (
+        f"Uncommitted changes in {', '.join(modified)}, "
+        "commit them or add their directories"
+    )
+    data.set_sparse_patterns(dirnames)
+    _apply_sparse_checkout(index)
+
+
+def is_sparse_path(path: str, patterns: list[str] | None) -> bool:
+    if patterns is None or "/" not in path:
+        return True
+    return any(path.startswith(f"{pattern}/") for pattern in patterns)
+
+
+def _is_sparse_dir(dirname: str, patterns: list[str] | None) -> bool:
+    # True if anything below dirname can be checked out
+    if patterns is None:
+        return True
+    return any(
+        dirname == pattern
+        or dirname.startswith(f"{pattern}/")
+        or pattern.startswith(f"{dirname}/")
+        for pattern in patterns
+    )
+
+
+def sparse_tree(tree: dict) -> dict:
+    # The part of a tree that is expected in the working directory
+    patterns = data.get_sparse_patterns()
+    if patterns is None:
+        return tree
+    return {path: oid for path, oid in tree.items() if is_sparse_path(path, patterns)}
+
+
+@trace.traced("worktree.sparse")
+def _apply_sparse_checkout(index: dict) -> None:
+    # Add or remove index entries in the working directory to match the
+    # sparse patterns, leaving files that stay checked out untouched
+    patterns = data.get_sparse_patterns()
+    for path, oid in index.items():
+        wanted = is_sparse_path(path, patterns)
+        if wanted and not os.path.exists(path):
+            _write_blob(path, oid)
+        elif not wanted and os.path.isfile(path):
+            os.remove(path)
+            try:
+                os.removedirs(os.path.dirname(path))
+            except OSError:
+                # Directory not empty, e.g. holds untracked files
+                pass
 
 
+@trace.traced("worktree.clear")
 def _empty_current_directory() -> None:
     for root, dirnames, filenames in os.walk(".", topdown=False):
         for filename in filenames:
@@ -326,6 +561,7 @@ def _empty_current_directory() -> None:
                 pass
 
 
+@trace.traced("tree.read")
 def read_tree(tree_oid: str, update_working=False) -> None:
     with data.get_index() as index:
         index.clear()
@@ -335,6 +571,7 @@ def read_tree(tree_oid: str, update_working=False) -> None:
             _checkout_index(index)
 
 
+@trace.traced("tree.read_merged")
 def read_tree_merged(t_base, t_HEAD, t_other, update_working=False):
     with data.get_index() as index:
         index.clear()
@@ -349,9 +586,17 @@ def read_tree_merged(t_base, t_HEAD, t_other, update_working=False):
             _checkout_index(index)
 
 
+@trace.traced("worktree.checkout")
 def _checkout_index(index):
     _empty_current_directory()
+    patterns = data.get_sparse_patterns()
     for path, oid in index.items():
-        os.makedirs(os.path.dirname(f"./{path}"), exist_ok=True)
-        with open(path, "wb") as f:
-            f.write(data.get_object(oid, "blob"))
+        if is_sparse_path(path, patterns):
+            _write_blob(path, oid)
+
+
+def _write_blob(path: str, oid: str) -> None:
+    os.makedirs(os.path.dirname(f"./{path}"), exist_ok=True)
+    with open(path, "wb") as f:
+        for content in data.iter_blob(oid):
+            f.write(content)
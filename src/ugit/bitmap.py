@@ -0,0 +1,264 @@
+import os
+import struct
+import threading
+
+from . import base, data, trace
+
+# Reachability bitmaps: the bitmap index numbers every object it knows, and
+# stores for selected commits (branch and tag tips, plus every
+# BITMAP_INTERVAL-th commit of the history) the set of objects reachable from
+# them as a bitmap over those numbers. "Reachable from A but not from B" then
+# comes down to walking from A and B to the nearest commits with a bitmap and
+# a few big-integer operations. Bitmaps are held in memory as Python ints and
+# stored EWAH-compressed (runs of empty or full 64-bit words plus literal
+# words).
+BITMAP_INTERVAL = 1000
+
+_MAGIC = b"UGITBMP1"
+_COMMIT = ord("c")
+_TYPE_CODES = {"commit": _COMMIT, "tree": ord("t"), "blob": ord("b")}
+
+_WORD = 0xFFFFFFFFFFFFFFFF
+_MAX_RUN = 0xFFFFFFFF
+_MAX_LITERALS = 0x7FFFFFFF
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+class BitmapIndex:
+    def __init__(self, objects: list[str] = None, types: bytearray = None, bitmaps: dict = None):
+        self.objects = objects or []
+        self.types = types or bytearray()
+        self.positions = {oid: pos for pos, oid in enumerate(self.objects)}
+        # Commit -> EWAH encoded bitmap, decoded on first use
+        self._encoded = bitmaps or {}
+        self._decoded = {}
+
+    def add(self, oid: str, type_: str) -> int:
+        pos = len(self.objects)
+        self.objects.append(oid)
+        self.types.append(_TYPE_CODES[type_])
+        self.positions[oid] = pos
+        return pos
+
+    def get_bitmap(self, commit: str) -> int | None:
+        bits = self._decoded.get(commit)
+        if bits is None and commit in self._encoded:
+            bits = self._decoded[commit] = _ewah_decode(self._encoded[commit])
+        return bits
+
+
+def write_bitmaps() -> int:
+    # Writes bitmaps for every ref tip, returns the number of bitmaps
+    with trace.span("bitmap.write"):
+        tips = {
+            ref.value for _, ref in data.iter_refs("refs/")
+            if data.object_type(ref.value) == "commit"
+        }
+        commits, _ = base.get_missing_commits(tips, lambda oid: False)
+        selected = tips | set(commits[BITMAP_INTERVAL - 1::BITMAP_INTERVAL])
+
+        index = BitmapIndex()
+        bitmaps = {}
+        # Parents first, so each walk stops at the closest bitmap built before
+        for oid in commits:
+            if oid in selected:
+                bitmaps[oid], _, _ = _walk(index, [oid], bitmaps.get, add_objects=True)
+
+        data.get_repository().write_bitmap_index(_serialize(index, bitmaps))
+        return len(bitmaps)
+
+
+def load() -> BitmapIndex | None:
+    repo = data.get_repository()
+    path = repo.bitmap_index_path
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    key = (stat.st_mtime_ns, stat.st_size)
+
+    with _cache_lock:
+        cached = _cache.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    with trace.span("bitmap.load"), open(path, "rb") as f:
+        index = _parse(f.read())
+    with _cache_lock:
+        _cache[path] = (key, index)
+    return index
+
+
+def find_objects(wants, haves):
+    # Objects reachable from wants but not from haves, like
+    # base.get_missing_commits() + base.iter_missing_objects() (commits last,
+    # parents first). Returns the commits and the objects, or None if the
+    # repository has no bitmap index.
+    index = load()
+    if index is None:
+        return None
+    trace.count("bitmap.queries")
+
+    want_bits, want_extra, want_commits = _walk(index, wants, index.get_bitmap)
+    have_bits, have_extra, _ = _walk(index, haves, index.get_bitmap)
+    have_extra = set(have_extra)
+    new_commits = set(want_commits)
+
+    objects = []
+    commits = []
+    for pos in _iter_bits(want_bits & ~have_bits):
+        if index.types[pos] == _COMMIT:
+            commits.append(index.objects[pos])
+        else:
+            objects.append(index.objects[pos])
+    # Objects newer than the index. They can't be ancestors of indexed
+    # commits, so appending them keeps commits in order.
+    for oid in want_extra:
+        if oid in have_extra:
+            continue
+        if oid in new_commits:
+            commits.append(oid)
+        else:
+            objects.append(oid)
+
+    return commits, objects + commits
+
+
+def _walk(index: BitmapIndex, tips, get_bitmap, add_objects=False):
+    # Objects reachable from tips: a bitmap of those in the index and, in
+    # order, the ones missing from it (or, with add_objects, add them to the
+    # index). Also returns the commits that had to be walked.
+    commits, reached = base.get_missing_commits(
+        tips, lambda oid: get_bitmap(oid) is not None
+    )
+    trace.count("bitmap.commits_walked", len(commits))
+
+    bits = 0
+    for oid in reached:
+        bits |= get_bitmap(oid)
+    # A bytearray for the walk, as testing single bits of a big int is slow
+    buf = bytearray(bits.to_bytes(len(index.objects) // 8 + 1, "little"))
+    extra = []
+    extra_seen = set()
+
+    def add(oid: str, type_: str) -> bool:
+        # Marks oid as reachable, returns False if it already was
+        pos = index.positions.get(oid)
+        if pos is None:
+            if not add_objects:
+                if oid in extra_seen:
+                    return False
+                extra_seen.add(oid)
+                extra.append(oid)
+                return True
+            pos = index.add(oid, type_)
+        byte, mask = pos >> 3, 1 << (pos & 7)
+        if byte >= len(buf):
+            buf.extend(bytes(byte - len(buf) + 1))
+        if buf[byte] & mask:
+            return False
+        buf[byte] |= mask
+        return True
+
+    def add_tree(oid: str) -> None:
+        # A tree that is already marked comes with everything below it
+        if not add(oid, "tree"):
+            return
+        for type_, entry_oid, _ in base._iter_tree_entries(oid):
+            if type_ == "tree":
+                add_tree(entry_oid)
+            elif add(entry_oid, "blob") and data.object_exists(entry_oid):
+                # Blobs left out by a filtered fetch stay on the remote, with
+                # their chunks
+                for chunk_oid in data.get_chunk_oids(entry_oid):
+                    add(chunk_oid, "blob")
+
+    for oid in commits:
+        add_tree(base.get_commit(oid).tree)
+        add(oid, "commit")
+
+    return int.from_bytes(buf, "little"), extra, commits
+
+
+def _iter_bits(bits: int):
+    # Positions of the set bits, lowest first
+    digits = bin(bits)[:1:-1]
+    pos = digits.find("1")
+    while pos != -1:
+        yield pos
+        pos = digits.find("1", pos + 1)
+
+
+# File format, integers little-endian:
+#   magic, object count (u64), 20-byte oid per object, type code per object,
+#   bitmap count (u64), then per bitmap: 20-byte commit oid, word count (u64),
+#   EWAH words (u64 each)
+
+def _serialize(index: BitmapIndex, bitmaps: dict) -> bytes:
+    parts = [_MAGIC, struct.pack("<Q", len(index.objects))]
+    parts.extend(bytes.fromhex(oid) for oid in index.objects)
+    parts.append(bytes(index.types))
+    parts.append(struct.pack("<Q", len(bitmaps)))
+    for commit, bits in bitmaps.items():
+        words = _ewah_encode(bits)
+        parts.append(bytes.fromhex(commit))
+        parts.append(struct.pack(f"<Q{len(words)}Q", len(words), *words))
+    return b"".join(parts)
+
+
+def _parse(content: bytes) -> BitmapIndex:
+    assert content.startswith(_MAGIC), "Not a bitmap index"
+    offset = len(_MAGIC)
+    (count,) = struct.unpack_from("<Q", content, offset)
+    offset += 8
+    objects = [content[i:i + 20].hex() for i in range(offset, offset + 20 * count, 20)]
+    offset += 20 * count
+    types = bytearray(content[offset:offset + count])
+    offset += count
+
+    bitmaps = {}
+    (count,) = struct.unpack_from("<Q", content, offset)
+    offset += 8
+    for _ in range(count):
+        commit = content[offset:offset + 20].hex()
+        (nwords,) = struct.unpack_from("<Q", content, offset + 20)
+        offset += 28
+        bitmaps[commit] = struct.unpack_from(f"<{nwords}Q", content, offset)
+        offset += 8 * nwords
+    return BitmapIndex(objects, types, bitmaps)
+
+
+def _ewah_encode(bits: int) -> list[int]:
+    # A marker word (run bit, run length: 32 bits, literal count: 31 bits)
+    # followed by the literal words, repeated
+    nwords = (bits.bit_length() + 63) // 64
+    words = struct.unpack(f"<{nwords}Q", bits.to_bytes(nwords * 8, "little"))
+    encoded = []
+    i = 0
+    while i < nwords:
+        run_bit = 1 if words[i] == _WORD else 0
+        run_word = _WORD if run_bit else 0
+        run = 0
+        while i < nwords and words[i] == run_word and run < _MAX_RUN:
+            run += 1
+            i += 1
+        start = i
+        while i < nwords and words[i] not in (0, _WORD) and i - start < _MAX_LITERALS:
+            i += 1
+        encoded.append(run_bit | run << 1 | (i - start) << 33)
+        encoded.extend(words[start:i])
+    return encoded
+
+
+def _ewah_decode(encoded) -> int:
+    words = []
+    i = 0
+    while i < len(encoded):
+        marker = encoded[i]
+        run_bit, run, literals = marker & 1, (marker >> 1) & _MAX_RUN, marker >> 33
+        words.extend([_WORD if run_bit else 0] * run)
+        words.extend(encoded[i + 1:i + 1 + literals])
+        i += 1 + literals
+    return int.from_bytes(struct.pack(f"<{len(words)}Q", *words), "little")
@@ -0,0 +1,96 @@
+import hashlib
+
+# Content-defined chunking with a gear rolling hash (as in FastCDC). A chunk
+# ends where the bits of the hash selected by CHUNK_MASK are all zero. Those
+# only depend on the last CHUNK_AVG_BITS bytes, so an edit only changes the
+# chunks around it and everything else deduplicates.
+CHUNK_MIN_SIZE = 16 * 1024
+CHUNK_AVG_BITS = 16  # 64 KiB average chunks
+CHUNK_MAX_SIZE = 256 * 1024
+CHUNK_MASK = (1 << CHUNK_AVG_BITS) - 1
+
+READ_SIZE = 1024 * 1024
+
+# Fixed random values per byte, derived from SHA-1 so they never change
+_GEAR = [
+    int.from_bytes(hashlib.sha1(bytes([i])).digest()[:4], "big")
+    for i in range(256)
+]
+
+
+# Only the low CHUNK_AVG_BITS bits of the hash decide a cut, and those only
+# depend on the last CHUNK_AVG_BITS bytes: byte j positions back adds
+# (gear value << j). That allows testing a whole block of positions at once
+# with big-int arithmetic instead of a Python loop per byte: every position
+# gets a lane of twice that many bits (wide enough for the sum, so lanes
+# never carry into each other), holding the masked gear value of its byte,
+# and shifted copies add up the window.
+_LANE_BITS = 2 * CHUNK_AVG_BITS
+_LANE_BYTES = _LANE_BITS // 8
+# Masked gear values, one translate table per byte of them
+_GEAR_TABLES = [
+    bytes((g & CHUNK_MASK) >> (8 * k) & 0xFF for g in _GEAR)
+    for k in range((CHUNK_AVG_BITS + 7) // 8)
+]
+# Positions tested at once, cuts come every 64 KiB on average
+_SEARCH_BLOCK = 32 * 1024
+
+
+def _find_cut(buf: memoryview) -> int:
+    size = len(buf)
+    if size <= CHUNK_MIN_SIZE:
+        return size
+    end = min(size, CHUNK_MAX_SIZE)
+
+    window = CHUNK_AVG_BITS
+    for start in range(CHUNK_MIN_SIZE, end, _SEARCH_BLOCK):
+        # The block plus the bytes before it that still count
+        block = bytes(buf[start - window + 1:min(start + _SEARCH_BLOCK, end)])
+        pos = _find_zero_hash(block, window - 1)
+        if pos != -1:
+            return start - window + 1 + pos + 1
+    return end
+
+
+def _find_zero_hash(block: bytes, start: int) -> int:
+    # First position from start on where the masked hash is zero, or -1
+    count = len(block)
+    lanes = bytearray(count * _LANE_BYTES)
+    for k, table in enumerate(_GEAR_TABLES):
+        lanes[k::_LANE_BYTES] = block.translate(table)
+    sums = int.from_bytes(lanes, "little")
+
+    # Add the lanes of the previous positions, doubling the window each time
+    span = 1
+    while span < CHUNK_AVG_BITS:
+        sums += sums << (span * (_LANE_BITS + 1))
+        span *= 2
+
+    raw = sums.to_bytes(count * _LANE_BYTES + sums.bit_length() // 8, "little")
+    low = 0
+    for k in range(len(_GEAR_TABLES)):
+        low |= int.from_bytes(raw[k:count * _LANE_BYTES:_LANE_BYTES], "little")
+    return low.to_bytes(count, "little").find(0, start)
+
+
+def iter_chunks(f):
+    # Splits a binary file object into chunks. Cut points only depend on the
+    # content, never on how the file happens to be read.
+    buf = bytearray()
+    start = 0
+    eof = False
+    while True:
+        if not eof and len(buf) - start < CHUNK_MAX_SIZE:
+            del buf[:start]
+            start = 0
+            block = f.read(READ_SIZE)
+            eof = not block
+            buf += block
+            continue
+        if start == len(buf):
+            return
+        with memoryview(buf) as view:
+            cut = _find_cut(view[start:])
+            chunk = bytes(view[start:start + cut])
+        start += cut
+        yield chunk
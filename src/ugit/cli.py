@@ -1,20 +1,37 @@
 import argparse
-import os
 import subprocess
 import sys
 import textwrap
 
-from . import base, data, diff, remote
+from . import base, bitmap, data, diff, remote, trace
 
 
 def main() -> None:
     with data.change_git_dir("."):
         args = parse_args()
-        args.func(args)
+        if args.trace or args.trace_output:
+            trace.enable(args.trace_output)
+        else:
+            trace.enable_from_env()
+        try:
+            with trace.span(f"command.{args.command}"):
+                args.func(args)
+                data.sync_pending()
+        except (data.LockError, data.RefConflictError) as e:
+            # Expected when another ugit process is busy with the same files
+            sys.exit(f"error: {e}")
+        finally:
+            trace.report()
 
 
 def parse_args() -> None:
     parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--trace", action="store_true", help="print timings and counters to stderr"
+    )
+    parser.add_argument(
+        "--trace-output", metavar="FILE", help="write a Chrome trace JSON to FILE"
+    )
 
     commands = parser.add_subparsers(dest="command")
     commands.required = True
@@ -23,18 +40,29 @@ def parse_args() -> None:
 
     init_parser = commands.add_parser("init")
     init_parser.set_defaults(func=init)
+    init_parser.add_argument(
+        "--chunk-threshold",
+        type=int,
+        metavar="BYTES",
+        help="store files larger than BYTES as deduplicated chunks",
+    )
 
     hash_object_parser = commands.add_parser("hash-object")
     hash_object_parser.set_defaults(func=hash_object)
-    hash_object_parser.add_argument("file")
+    hash_object_parser.add_argument("file", nargs="?")
+    hash_object_parser.add_argument("--stdin-paths", action="store_true")
 
     cat_file_parser = commands.add_parser("cat-file")
     cat_file_parser.set_defaults(func=cat_file)
-    cat_file_parser.add_argument("object", type=oid)
+    cat_file_parser.add_argument("object", type=oid, nargs="?")
+    cat_file_parser.add_argument("--batch", action="store_true")
 
     write_tree_parser = commands.add_parser("write-tree")
     write_tree_parser.set_defaults(func=write_tree)
 
+    write_bitmaps_parser = commands.add_parser("write-bitmaps")
+    write_bitmaps_parser.set_defaults(func=write_bitmaps)
+
     read_tree_parser = commands.add_parser("read-tree")
     read_tree_parser.set_defaults(func=read_tree)
     read_tree_parser.add_argument("tree", type=oid)
@@ -93,12 +121,25 @@ def parse_args() -> None:
     fetch_parser = commands.add_parser("fetch")
     fetch_parser.set_defaults(func=fetch)
     fetch_parser.add_argument("remote")
+    fetch_parser.add_argument("--depth", type=int, help="fetch only the last DEPTH commits")
+    fetch_parser.add_argument(
+        "--filter",
+        type=_blob_filter,
+        dest="blob_limit",
+        metavar="blob:limit=BYTES",
+        help="fetch blobs larger than BYTES only when they are needed",
+    )
 
     push_parser = commands.add_parser("push")
     push_parser.set_defaults(func=push)
     push_parser.add_argument("remote")
     push_parser.add_argument("branch")
 
+    sparse_parser = commands.add_parser("sparse-checkout")
+    sparse_parser.set_defaults(func=sparse_checkout)
+    sparse_parser.add_argument("action", choices=["set", "add", "list", "disable"])
+    sparse_parser.add_argument("directories", nargs="*")
+
     add_parser = commands.add_parser("add")
     add_parser.set_defaults(func=add)
     add_parser.add_argument("files", nargs="+")
@@ -106,25 +147,87 @@ def parse_args() -> None:
     return parser.parse_args()
 
 
+def _blob_filter(spec: str) -> int:
+    kind, _, limit = spec.partition(":limit=")
+    if kind != "blob" or not limit.isdigit():
+        raise argparse.ArgumentTypeError(f"unsupported filter {spec}")
+    return int(limit)
+
+
 def init(args: argparse.Namespace) -> None:
-    base.init()
-    print(f"Initializated empty ugit reposiroty in {os.getcwd()}/{data.GIT_DIR}")
+    base.init(args.chunk_threshold)
+    print(f"Initializated empty ugit reposiroty in {data.get_repository().git_dir}")
 
 
 def hash_object(args: argparse.Namespace) -> None:
-    with open(args.file, "rb") as f:
-        print(data.hash_object(f.read()))
+    if args.stdin_paths:
+        _hash_object_batch()
+        return
+    assert args.file, "Either a file or --stdin-paths is required"
+    print(data.hash_file(args.file))
 
 
 def cat_file(args: argparse.Namespace) -> None:
+    if args.batch:
+        _cat_file_batch()
+        return
+    assert args.object, "Either an object or --batch is required"
     sys.stdout.flush()
+    if data.object_type(args.object) == "chunked":
+        # How large files are stored doesn't show, print the file itself
+        for content in data.iter_blob(args.object):
+            sys.stdout.buffer.write(content)
+        return
     sys.stdout.buffer.write(data.get_object(args.object, exptected=None))
 
 
+# Batch modes read one request per line from stdin and keep the output
+# buffered; a "flush" line (or EOF) pushes everything written so far.
+def _iter_batch_lines():
+    for line in sys.stdin.buffer:
+        line = line.rstrip(b"\n").decode()
+        if line == "flush":
+            sys.stdout.buffer.flush()
+            continue
+        if line:
+            yield line
+    sys.stdout.buffer.flush()
+
+
+def _hash_object_batch() -> None:
+    out = sys.stdout.buffer
+    for path in _iter_batch_lines():
+        out.write(f"{data.hash_file(path)}\n".encode())
+
+
+def _cat_file_batch() -> None:
+    out = sys.stdout.buffer
+    for name in _iter_batch_lines():
+        try:
+            oid = base.get_oid(name)
+            type_, content = data.read_object(oid)
+        except (AssertionError, FileNotFoundError):
+            out.write(f"{name} missing\n".encode())
+            continue
+        if type_ == "chunked":
+            # Reported and written like any other blob
+            out.write(f"{oid} blob {data.blob_size(oid)}\n".encode())
+            for content in data.iter_blob(oid):
+                out.write(content)
+        else:
+            out.write(f"{oid} {type_} {len(content)}\n".encode())
+            out.write(content)
+        out.write(b"\n")
+
+
 def write_tree(args: argparse.Namespace) -> None:
     print(base.write_tree())
 
 
+def write_bitmaps(args: argparse.Namespace) -> None:
+    print(f"Wrote {bitmap.write_bitmaps()} bitmaps")
+
+
 def read_tree(args: argparse.Namespace) -> None:
     base.read_tree(args.tree)
 
@@ -184,6 +287,8 @@ def _diff(args: argparse.Namespace) -> None:
         if not args.commit:
             # If no commit was provided, diff from HEAD
             tree_from = base.get_index_tree()
+        # Paths outside a sparse checkout aren't missing, just not checked out
+        tree_from = base.sparse_tree(tree_from)
 
     result = diff.diff_trees(tree_from, tree_to)
     sys.stdout.flush()
@@ -255,7 +360,7 @@ def status(args: argparse.Namespace) -> None:
 
     print(f"\nChanges not staged for commit:\n")
     for path, action in diff.iter_changed_files(
-        base.get_index_tree(),
+        base.sparse_tree(base.get_index_tree()),
         base.get_working_tree()
     ):
         print(f"{action:>12}: {path}")
@@ -274,12 +379,28 @@ def merge_base(args: argparse.Namespace) -> None:
 
 
 def fetch(args: argparse.Namespace) -> None:
-    remote.fetch(args.remote)
+    assert args.depth is None or args.depth > 0, "Depth must be positive"
+    remote.fetch(args.remote, depth=args.depth, blob_limit=args.blob_limit)
 
 
 def push(args: argparse.Namespace) -> None:
     remote.push(args.remote, f"refs/heads/{args.branch}")
 
 
+def sparse_checkout(args: argparse.Namespace) -> None:
+    current = data.get_sparse_patterns()
+    if args.action == "list":
+        for directory in current or []:
+            print(directory)
+    elif args.action == "set":
+        assert args.directories, "No directories given"
+        base.set_sparse_checkout(args.directories)
+    elif args.action == "add":
+        assert args.directories, "No directories given"
+        base.set_sparse_checkout((current or []) + args.directories)
+    else:
+        base.set_sparse_checkout(None)
+
+
 def add(args: argparse.Namespace) -> None:
     base.add(args.files)
@@ -1,26 +1,63 @@
+from collections import OrderedDict
 from contextlib import contextmanager
+import contextvars
 import hashlib
+import io
 import json
 import os
-import shutil
+import secrets
+import threading
+import time
 from typing import NamedTuple
 
-# Will be initialized in cli.main()
-GIT_DIR = None
+from . import chunking
+from . import trace
 
+# How hard to push written files to disk, picked with $UGIT_FSYNC:
+#   none   - leave it to the OS
+#   batch  - fsync the files written so far once, before a ref or the index
+#            is written
+#   always - fsync every file and its directory as it is written
+FSYNC_POLICIES = ("none", "batch", "always")
+DEFAULT_FSYNC_POLICY = "batch"
 
-@contextmanager
-def change_git_dir(new_dir: str):
-    global GIT_DIR
-    old_dir = GIT_DIR
-    GIT_DIR = f"{new_dir}/.ugit"
-    yield
-    GIT_DIR = old_dir
+# With the batch policy, sync anyway once this many files are pending, so
+# commands writing many objects without a ref don't pile them up
+SYNC_BATCH_SIZE = 1000
+
+# Seconds to wait for another process to release a lockfile
+LOCK_TIMEOUT = 1.0
+
+# Parsed objects each repository keeps in memory, in total bytes. Only
+# metadata (commits, trees, chunk manifests) up to OBJECT_CACHE_MAX_BYTES
+# each is cached, file contents never are.
+OBJECT_CACHE_TOTAL_BYTES = 8 * 1024 * 1024
+OBJECT_CACHE_MAX_BYTES = 64 * 1024
+
+# Repositories open_repository() keeps around (with their caches) for reuse,
+# least recently used ones are dropped first
+MAX_OPEN_REPOSITORIES = 32
+
+# A file's cached oid is only trusted if the file was already this old
+# (in ns) when it was hashed, since a change within the filesystem's
+# timestamp granularity wouldn't show
+STAT_CACHE_MIN_AGE = 2 * 10**9
 
+# Repository the module-level functions work on, set by change_git_dir(). It
+# is per thread (and per asyncio task), so threads can't see each other's
+# repository.
+_current_repository = contextvars.ContextVar("ugit_repository", default=None)
 
-def init() -> None:
-    os.makedirs(GIT_DIR)
-    os.makedirs(f"{GIT_DIR}/objects")
+_repositories = OrderedDict()
+_repositories_lock = threading.Lock()
+
+
+class LockError(Exception):
+    pass
+
+
+class RefConflictError(Exception):
+    pass
 
 
 class RefValue(NamedTuple):
@@ -28,109 +65,666 @@ class RefValue(NamedTuple):
     value: str
 
 
-def update_ref(ref: str, value: RefValue, deref=True) -> None:
-    ref = _get_ref_internal(ref, deref)[0]
+# No ref at all, as an expected old value: the update must create the ref
+MISSING_REF = RefValue(symbolic=False, value=None)
+
+
+def get_fsync_policy() -> str:
+    policy = os.environ.get("UGIT_FSYNC", DEFAULT_FSYNC_POLICY)
+    assert policy in FSYNC_POLICIES, f"Unknown fsync policy {policy}"
+    return policy
+
+
+def _fsync_dir(path: str) -> None:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class _LockFile:
+    def __init__(self, repo: "Repository", path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.repo = repo
+        self.path = path
+        self.lock_path = f"{path}.lock"
+        deadline = time.monotonic() + LOCK_TIMEOUT
+        while True:
+            try:
+                self.fd = os.open(
+                    self.lock_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666
+                )
+                break
+            except FileExistsError:
+                if time.monotonic() >= deadline:
+                    raise LockError(f"Unable to lock {path}: {self.lock_path} exists")
+                time.sleep(0.005)
+
+    def write(self, content: bytes) -> None:
+        view = memoryview(content)
+        while view:
+            view = view[os.write(self.fd, view):]
+
+    def commit(self) -> None:
+        policy = get_fsync_policy()
+        if policy != "none":
+            self.repo.sync_pending()
+            os.fsync(self.fd)
+        os.close(self.fd)
+        self.fd = None
+        os.replace(self.lock_path, self.path)
+        if policy != "none":
+            _fsync_dir(os.path.dirname(self.path))
+
+    def rollback(self) -> None:
+        if self.fd is None:
+            return
+        os.close(self.fd)
+        self.fd = None
+        os.remove(self.lock_path)
+
+
+class Repository:
+    # Everything stored under one .ugit directory. Safe to share between
+    # threads: on-disk state is guarded by lockfiles, in-memory state by
+    # self._lock.
+    def __init__(self, git_dir: str):
+        self.git_dir = git_dir
+        self.objects_dir = f"{git_dir}/objects"
+        self.bitmap_index_path = f"{git_dir}/bitmap-index"
+        self._lock = threading.Lock()
+        # Files written since the last sync, with the batch policy
+        self._pending_sync = set()
+        self._object_cache = OrderedDict()
+        self._object_cache_bytes = 0
+        self._chunk_threshold = None
+        self._shallow = None
+        self._stat_cache = None
+
+    def init(self, chunk_threshold: int = None) -> None:
+        os.makedirs(self.git_dir)
+        os.makedirs(self.objects_dir)
+        if chunk_threshold is not None:
+            self.set_chunk_threshold(chunk_threshold)
+
+    @property
+    def chunk_threshold(self) -> int | None:
+        # Blobs larger than this are stored chunked, None disables chunking.
+        # It's fixed per repository, as it decides the oid of large files.
+        if self._chunk_threshold is None:
+            threshold = -1
+            path = f"{self.git_dir}/chunk-threshold"
+            if os.path.isfile(path):
+                with open(path) as f:
+                    threshold = int(f.read())
+            self._chunk_threshold = threshold
+        return self._chunk_threshold if self._chunk_threshold >= 0 else None
+
+    def set_chunk_threshold(self, threshold: int) -> None:
+        self._write_file(f"{self.git_dir}/chunk-threshold", f"{threshold}\n".encode())
+        self._chunk_threshold = threshold
+
+    def sync_pending(self) -> None:
+        # Make sure the objects a ref or the index is about to point at are
+        # on disk before the pointer itself is. Also called once a command
+        # is done, for objects nothing points at yet.
+        with self._lock:
+            paths, self._pending_sync = self._pending_sync, set()
+        for path in paths:
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except FileNotFoundError:
+                # Removed again since, nothing to sync
+                continue
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        for dirname in {os.path.dirname(path) for path in paths}:
+            _fsync_dir(dirname)
+
+    def _write_file(self, path: str, content: bytes) -> None:
+        # Write to a temporary file next to the target and rename it into
+        # place, so readers never see a partially written file
+        policy = get_fsync_policy()
+        dirname = os.path.dirname(path)
+        # Not mkstemp(), its files are private (0600) instead of following
+        # the umask like a plain open() does
+        tmp_path = f"{dirname}/.tmp-{secrets.token_hex(8)}"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+                if policy == "always":
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        if policy == "always":
+            _fsync_dir(dirname)
+        elif policy == "batch":
+            with self._lock:
+                self._pending_sync.add(path)
+                full = len(self._pending_sync) >= SYNC_BATCH_SIZE
+            if full:
+                self.sync_pending()
+
+    @contextmanager
+    def _locked(self, path: str):
+        lock = _LockFile(self, path)
+        try:
+            yield lock
+        finally:
+            lock.rollback()
+
+    def update_ref(self, ref: str, value: RefValue, deref=True, old: RefValue = None) -> None:
+        with self.ref_transaction() as transaction:
+            transaction.update(ref, value, deref=deref, old=old)
+
+    def get_ref(self, ref: str, deref=True) -> RefValue:
+        return self._get_ref_internal(ref, deref)[1]
+
+    def delete_ref(self, ref: str, deref=True, old: RefValue = None) -> None:
+        with self.ref_transaction() as transaction:
+            transaction.delete(ref, deref=deref, old=old)
+
+    def _get_ref_internal(self, ref: str, deref: bool) -> tuple[str, RefValue]:
+        trace.count("refs.read")
+        ref_path = f"{self.git_dir}/{ref}"
+        value = None
+        if os.path.isfile(ref_path):
+            with open(ref_path) as f:
+                value = f.read().strip()
+
+        symbolic = bool(value) and value.startswith("ref:")
+        if symbolic:
+            value = value.split(":", 1)[1].strip()
+            if deref:
+                return self._get_ref_internal(value, deref=True)
+
+        return ref, RefValue(symbolic=symbolic, value=value)
+
+    @contextmanager
+    def ref_transaction(self):
+        transaction = RefTransaction(self)
+        yield transaction
+        transaction.commit()
+
+    def iter_refs(self, prefix="", deref=True):
+        refs = ["HEAD", "MERGE_HEAD"]
+        for root, _, filenames in os.walk(f"{self.git_dir}/refs/"):
+            root = os.path.relpath(root, self.git_dir)
+            refs.extend(
+                f'{root}/{name}' for name in filenames
+                if not name.endswith(".lock") and not name.startswith(".tmp-")
+            )
+
+        for refname in refs:
+            if not refname.startswith(prefix):
+                continue
+            ref = self.get_ref(refname, deref)
+            if ref.value:
+                yield refname, ref
+
+    def read_index(self) -> dict:
+        # The index as it is now, without locking. It's only ever replaced
+        # by a rename, so this never sees a partial write.
+        index_path = f"{self.git_dir}/index"
+        with trace.span("index.load"):
+            if not os.path.isfile(index_path):
+                return {}
+            with open(index_path) as f:
+                return json.load(f)
+
+    @contextmanager
+    def get_index(self):
+        # For changing the index: it stays locked until the block ends, so
+        # concurrent writers can't drop each other's changes
+        index_path = f"{self.git_dir}/index"
+        with self._locked(index_path) as lock:
+            index = self.read_index()
+            original = dict(index)
+
+            yield index
+
+            # Read-only users leave the index untouched, no need to rewrite it
+            if index != original:
+                with trace.span("index.save"):
+                    lock.write(json.dumps(index).encode())
+                    lock.commit()
+
+    def get_sparse_patterns(self) -> list[str] | None:
+        # Directories checked out in a sparse working tree, None when the
+        # whole tree is checked out
+        path = f"{self.git_dir}/info/sparse-checkout"
+        if not os.path.isfile(path):
+            return None
+        with open(path) as f:
+            return [line for line in f.read().splitlines() if line]
+
+    def set_sparse_patterns(self, patterns: list[str] | None) -> None:
+        path = f"{self.git_dir}/info/sparse-checkout"
+        if patterns is None:
+            if os.path.isfile(path):
+                os.remove(path)
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._write_file(path, "".join(f"{p}\n" for p in patterns).encode())
+
+    def get_shallow(self) -> frozenset:
+        # Commits whose parents weren't fetched (see "fetch --depth"). Read
+        # once per Repository, set_shallow() keeps it up to date.
+        with self._lock:
+            shallow = self._shallow
+        if shallow is None:
+            shallow = frozenset()
+            path = f"{self.git_dir}/shallow"
+            if os.path.isfile(path):
+                with open(path) as f:
+                    shallow = frozenset(f.read().split())
+            with self._lock:
+                self._shallow = shallow
+        return shallow
+
+    def set_shallow(self, oids) -> None:
+        shallow = frozenset(oids)
+        path = f"{self.git_dir}/shallow"
+        if shallow:
+            self._write_file(path, "".join(f"{oid}\n" for oid in sorted(shallow)).encode())
+        elif os.path.isfile(path):
+            os.remove(path)
+        with self._lock:
+            self._shallow = shallow
+
+    def get_promisor(self) -> str | None:
+        # Remote that promised to provide objects left out by a filtered fetch
+        path = f"{self.git_dir}/promisor"
+        if not os.path.isfile(path):
+            return None
+        with open(path) as f:
+            return f.read().strip()
+
+    def set_promisor(self, remote_path: str) -> None:
+        self._write_file(f"{self.git_dir}/promisor", f"{remote_path}\n".encode())
+
+    def write_bitmap_index(self, content: bytes) -> None:
+        self._write_file(self.bitmap_index_path, content)
+
+    def _open_object(self, oid: str):
+        try:
+            return open(f"{self.objects_dir}/{oid}", "rb")
+        except FileNotFoundError:
+            # Left out by a filtered fetch, get it from the remote now
+            promisor = self.get_promisor()
+            if promisor is None:
+                raise
+            remote = open_repository(f"{promisor}/.ugit")
+            trace.count("objects.lazy_fetched")
+            self.copy_object_from(remote, oid)
+            return open(f"{self.objects_dir}/{oid}", "rb")
+
+    def hash_object(self, data: bytes, type_="blob") -> str:
+        threshold = self.chunk_threshold
+        if type_ == "blob" and threshold is not None and len(data) > threshold:
+            return self._hash_chunked(io.BytesIO(data))
+        return self._hash_object_raw(data, type_)
+
+    def hash_file(self, path: str) -> str:
+        # Like hash_object() on the file contents, but large files are
+        # chunked as they are read instead of being loaded whole. Chunking
+        # is slow, so their oids are cached by stat data.
+        threshold = self.chunk_threshold
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            if threshold is None or stat.st_size <= threshold:
+                return self._hash_object_raw(f.read(), "blob")
+
+            key = os.path.relpath(os.path.abspath(path), os.path.dirname(self.git_dir))
+            # Like git's index: the mtime alone can be restored (cp -p,
+            # rsync -t, tar), the ctime can't and changes with it
+            stat_data = [
+                stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns, stat.st_ino, stat.st_dev
+            ]
+            cached = self._get_stat_cache().get(key)
+            if (
+                cached is not None
+                and cached[:-1] == stat_data
+                and self.object_exists(cached[-1])
+            ):
+                trace.count("objects.stat_cache_hits")
+                return cached[-1]
+
+            start = time.time_ns()
+            oid = self._hash_chunked(f)
+            if max(stat.st_mtime_ns, stat.st_ctime_ns) < start - STAT_CACHE_MIN_AGE:
+                self._update_stat_cache(key, stat_data + [oid])
+            return oid
+
+    def _get_stat_cache(self) -> dict:
+        with self._lock:
+            if self._stat_cache is None:
+                self._stat_cache = {}
+                path = f"{self.git_dir}/stat-cache"
+                if os.path.isfile(path):
+                    with open(path) as f:
+                        self._stat_cache = json.load(f)
+            return self._stat_cache
+
+    def _update_stat_cache(self, key: str, entry: list) -> None:
+        cache = self._get_stat_cache()
+        with self._lock:
+            cache[key] = entry
+            content = json.dumps(cache).encode()
+        # Last writer wins, a lost entry only costs hashing the file again
+        self._write_file(f"{self.git_dir}/stat-cache", content)
+
+    def _hash_chunked(self, f) -> str:
+        # A chunked blob is a manifest object listing "<oid> <size>" of each
+        # chunk, the chunks are stored as ordinary blobs
+        with trace.span("objects.chunk"):
+            manifest = "".join(
+                f"{self._hash_object_raw(chunk, 'blob')} {len(chunk)}\n"
+                for chunk in chunking.iter_chunks(f)
+            )
+        return self._hash_object_raw(manifest.encode(), "chunked")
+
+    def _hash_object_raw(self, data: bytes, type_: str) -> str:
+        obj = type_.encode() + b"\x00" + data
+        oid = hashlib.sha1(obj).hexdigest()
+        trace.count("objects.hashed")
+        trace.count("objects.hashed_bytes", len(obj))
+        # Objects are immutable, an existing one is already what we would write
+        if not self.object_exists(oid):
+            trace.count("objects.written")
+            self._write_file(f"{self.objects_dir}/{oid}", obj)
+        return oid
+
+    def get_object(self, oid: str, exptected="blob") -> bytes:
+        type_, content = self.read_object(oid)
+
+        if type_ == "chunked" and exptected == "blob":
+            return b"".join(self.iter_blob(oid))
+        if exptected is not None:
+            assert type_ == exptected, f"Expected {exptected}, got {type_}"
+        return content
+
+    def read_object(self, oid: str) -> tuple[str, bytes]:
+        with self._lock:
+            cached = self._object_cache.get(oid)
+            if cached is not None:
+                self._object_cache.move_to_end(oid)
+                trace.count("objects.cache_hits")
+                return cached
+
+        with self._open_object(oid) as f:
+            obj = f.read()
+        trace.count("objects.read")
+        trace.count("objects.read_bytes", len(obj))
+
+        type_, _, content = obj.partition(b"\x00")
+        result = type_.decode(), content
+
+        if type_ != b"blob" and len(content) <= OBJECT_CACHE_MAX_BYTES:
+            with self._lock:
+                if oid not in self._object_cache:
+                    self._object_cache[oid] = result
+                    self._object_cache_bytes += len(content)
+                while self._object_cache_bytes > OBJECT_CACHE_TOTAL_BYTES:
+                    _, (_, evicted) = self._object_cache.popitem(last=False)
+                    self._object_cache_bytes -= len(evicted)
+        return result
+
+    def iter_blob(self, oid: str):
+        # Blob contents piece by piece, without joining chunked blobs
+        type_, content = self.read_object(oid)
+        if type_ != "chunked":
+            assert type_ == "blob", f"Expected blob, got {type_}"
+            yield content
+            return
+        for chunk_oid in self._parse_manifest(content):
+            yield self.get_object(chunk_oid, "blob")
+
+    def get_chunk_oids(self, oid: str) -> list[str]:
+        # Chunks of a chunked blob, nothing for any other object
+        if self.object_type(oid) != "chunked":
+            return []
+        return self._parse_manifest(self.get_object(oid, "chunked"))
+
+    def blob_size(self, oid: str) -> int:
+        # Size of the file contents, chunked or not
+        type_, content = self.read_object(oid)
+        if type_ != "chunked":
+            return len(content)
+        return sum(int(line.split(" ", 1)[1]) for line in content.decode().splitlines())
+
+    def _parse_manifest(self, manifest: bytes) -> list[str]:
+        return [line.split(" ", 1)[0] for line in manifest.decode().splitlines()]
+
+    def object_type(self, oid: str) -> str:
+        with self._lock:
+            cached = self._object_cache.get(oid)
+        if cached is not None:
+            return cached[0]
+        with self._open_object(oid) as f:
+            header = f.read(16)
+        return header.partition(b"\x00")[0].decode()
+
+    def object_exists(self, oid: str) -> bool:
+        return os.path.isfile(f"{self.objects_dir}/{oid}")
+
+    def object_size(self, oid: str) -> int:
+        # Size on disk, header included
+        return os.path.getsize(f"{self.objects_dir}/{oid}")
+
+    def copy_object_from(self, other: "Repository", oid: str) -> None:
+        trace.count("objects.copied")
+        with other._open_object(oid) as f:
+            self._write_file(f"{self.objects_dir}/{oid}", f.read())
+
+
+class RefTransaction:
+    # Collects ref updates and applies them all-or-nothing: every ref is
+    # locked, checked against its expected old value (if given) and only then
+    # are the new values renamed into place
+    def __init__(self, repo: Repository):
+        self.repo = repo
+        self.updates = []
+
+    def update(self, ref: str, value: RefValue, deref=True, old: RefValue = None) -> None:
+        assert value.value
+        self.updates.append((ref, value, deref, old))
+
+    def delete(self, ref: str, deref=True, old: RefValue = None) -> None:
+        self.updates.append((ref, None, deref, old))
+
+    @trace.traced("refs.transaction")
+    def commit(self) -> None:
+        trace.count("refs.written", len(self.updates))
+        repo = self.repo
+        updates = {}
+        for ref, value, deref, old in self.updates:
+            ref = repo._get_ref_internal(ref, deref)[0]
+            assert ref not in updates, f"Multiple updates for {ref}"
+            updates[ref] = (value, old)
+
+        locks = {}
+        try:
+            # Lock in a fixed order so concurrent transactions can't deadlock
+            for ref in sorted(updates):
+                locks[ref] = _LockFile(repo, f"{repo.git_dir}/{ref}")
+
+            for ref, (_, old) in updates.items():
+                current = repo._get_ref_internal(ref, deref=False)[1]
+                if old is not None and current != old:
+                    raise RefConflictError(
+                        f"{ref} is at {current.value}, expected {old.value}"
+                    )
+
+            for ref, (value, _) in updates.items():
+                if value is None:
+                    continue
+                if value.symbolic:
+                    locks[ref].write(f"ref: {value.value}".encode())
+                else:
+                    locks[ref].write(value.value.encode())
+
+            for ref, (value, _) in updates.items():
+                if value is None:
+                    ref_path = f"{repo.git_dir}/{ref}"
+                    if os.path.isfile(ref_path):
+                        os.remove(ref_path)
+                else:
+                    locks[ref].commit()
+        finally:
+            for lock in locks.values():
+                lock.rollback()
+
+
+def open_repository(git_dir: str) -> Repository:
+    # Hand out one Repository per directory, so its caches are shared by
+    # everyone working on it. Relative paths are resolved now, as the same
+    # relative path means another repository after a chdir. A Repository
+    # dropped from here stays usable by whoever still holds it: on-disk
+    # state is guarded by lockfiles, only the caches aren't shared anymore.
+    git_dir = os.path.realpath(git_dir)
+    with _repositories_lock:
+        repo = _repositories.get(git_dir)
+        if repo is None:
+            repo = _repositories[git_dir] = Repository(git_dir)
+            if len(_repositories) > MAX_OPEN_REPOSITORIES:
+                _repositories.popitem(last=False)
+        else:
+            _repositories.move_to_end(git_dir)
+        return repo
+
+
+def get_repository() -> Repository:
+    repo = _current_repository.get()
+    assert repo is not None, "No repository, use change_git_dir() first"
+    return repo
+
 
-    assert value.value
-    if value.symbolic:
-        value = f"ref: {value.value}"
-    else:
-        value = value.value
-    ref_path = f"{GIT_DIR}/{ref}"
-    os.makedirs(os.path.dirname(ref_path), exist_ok=True)
-    with open(ref_path, "w") as f:
-        f.write(value)
+@contextmanager
+def change_git_dir(new_dir: str):
+    token = _current_repository.set(open_repository(f"{new_dir}/.ugit"))
+    try:
+        yield
+    finally:
+        _current_repository.reset(token)
 
 
-def get_ref(ref: str, deref=True) -> RefValue:
-    return _get_ref_internal(ref, deref)[1]
+def __getattr__(name: str):
+    # GIT_DIR used to be a module global, keep it readable
+    if name == "GIT_DIR":
+        repo = _current_repository.get()
+        return repo and repo.git_dir
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
-def delete_ref(ref: str, deref=True) -> None:
-    ref = _get_ref_internal(ref, deref)[0]
-    os.remove(f"{GIT_DIR}/{ref}")
+# Module-level API, working on the current repository
 
+def init(chunk_threshold: int = None) -> None:
+    get_repository().init(chunk_threshold)
 
-def _get_ref_internal(ref: str, deref: bool) -> tuple[str, RefValue]:
-    ref_path = f"{GIT_DIR}/{ref}"
-    value = None
-    if os.path.isfile(ref_path):
-        with open(ref_path) as f:
-            value = f.read().strip()
-    
-    symbolic = bool(value) and value.startswith("ref:")
-    if symbolic:
-        value = value.split(":", 1)[1].strip()
-        if deref:
-            return _get_ref_internal(value, deref=True)
 
-    return ref, RefValue(symbolic=symbolic, value=value)
+def update_ref(ref: str, value: RefValue, deref=True, old: RefValue = None) -> None:
+    get_repository().update_ref(ref, value, deref=deref, old=old)
+
+
+def get_ref(ref: str, deref=True) -> RefValue:
+    return get_repository().get_ref(ref, deref)
+
+
+def delete_ref(ref: str, deref=True, old: RefValue = None) -> None:
+    get_repository().delete_ref(ref, deref=deref, old=old)
+
+
+def ref_transaction():
+    return get_repository().ref_transaction()
 
 
 def iter_refs(prefix="", deref=True):
-    refs = ["HEAD", "MERGE_HEAD"]
-    for root, _, filenames in os.walk(f"{GIT_DIR}/refs/"):
-        root = os.path.relpath(root, GIT_DIR)
-        refs.extend(f'{root}/{name}' for name in filenames)
-    
-    for refname in refs:
-        if not refname.startswith(prefix):
-            continue
-        ref = get_ref(refname, deref)
-        if ref.value:
-            yield refname, ref
+    return get_repository().iter_refs(prefix, deref)
+
+
+def read_index() -> dict:
+    return get_repository().read_index()
 
 
-@contextmanager
 def get_index():
-    index = {}
-    if os.path.isfile(f"{GIT_DIR}/index"):
-        with open(f"{GIT_DIR}/index") as f:
-            index = json.load(f)
+    return get_repository().get_index()
+
+
+def sync_pending() -> None:
+    get_repository().sync_pending()
+
+
+def get_sparse_patterns() -> list[str] | None:
+    return get_repository().get_sparse_patterns()
 
-    yield index
 
-    with open(f"{GIT_DIR}/index", "w") as f:
-        json.dump(index, f)
+def set_sparse_patterns(patterns: list[str] | None) -> None:
+    get_repository().set_sparse_patterns(patterns)
 
 
 def hash_object(data: bytes, type_="blob") -> str:
-    obj = type_.encode() + b"\x00" + data
-    oid = hashlib.sha1(obj).hexdigest()
-    with open(f"{GIT_DIR}/objects/{oid}", "wb") as out:
-        out.write(obj)
-    return oid
+    return get_repository().hash_object(data, type_)
+
+
+def hash_file(path: str) -> str:
+    return get_repository().hash_file(path)
 
 
 def get_object(oid: str, exptected="blob") -> bytes:
-    with open(f"{GIT_DIR}/objects/{oid}", "rb") as f:
-        obj = f.read()
+    return get_repository().get_object(oid, exptected)
+
+
+def iter_blob(oid: str):
+    return get_repository().iter_blob(oid)
+
 
-    type_, _, content = obj.partition(b"\x00")
-    type_ = type_.decode()
+def get_chunk_oids(oid: str) -> list[str]:
+    return get_repository().get_chunk_oids(oid)
 
-    if exptected is not None:
-        assert type_ == exptected, f"Expected {exptected}, got {type_}"
-    return content
+
+def blob_size(oid: str) -> int:
+    return get_repository().blob_size(oid)
+
+
+def object_type(oid: str) -> str:
+    return get_repository().object_type(oid)
+
+
+def read_object(oid: str) -> tuple[str, bytes]:
+    return get_repository().read_object(oid)
 
 
 def object_exists(oid: str) -> bool:
-    return os.path.isfile(f"{GIT_DIR}/objects/{oid}")
+    return get_repository().object_exists(oid)
+
+
+def get_shallow() -> frozenset:
+    return get_repository().get_shallow()
+
+
+def set_shallow(oids) -> None:
+    get_repository().set_shallow(oids)
+
+
+def set_promisor(remote_path: str) -> None:
+    get_repository().set_promisor(remote_path)
 
 
 def fetch_object_if_missing(oid: str, remote_git_dir: str) -> None:
-    if object_exists(oid):
+    repo = get_repository()
+    if repo.object_exists(oid):
         return
-    remote_git_dir += "/.ugit"
-    shutil.copy(
-        f"{remote_git_dir}/objects/{oid}",
-        f"{GIT_DIR}/objects/{oid}"
-    )
+    repo.copy_object_from(open_repository(f"{remote_git_dir}/.ugit"), oid)
 
 
 def push_object(oid: str, remote_git_dir: str) -> None:
-    remote_git_dir += "/.ugit"
-    shutil.copy(
-        f"{GIT_DIR}/objects/{oid}",
-        f"{remote_git_dir}/objects/{oid}"
-    )
+    open_repository(f"{remote_git_dir}/.ugit").copy_object_from(get_repository(), oid)
@@ -3,6 +3,7 @@ import subprocess
 from tempfile import NamedTemporaryFile as Temp
 
 from . import data
+from . import trace
 
 
 def compare_trees(*trees: dict):
@@ -39,7 +40,8 @@ def diff_blobs(o_from, o_to, path="blob") -> str:
                 f.write(data.get_object(oid))
                 f.flush()
 
-        with subprocess.Popen(
+        trace.count("subprocess.spawned")
+        with trace.span("subprocess.diff"), subprocess.Popen(
             [
                 "diff",
                 "--unified",
@@ -72,7 +74,8 @@ def merge_blobs(o_base, o_HEAD, o_other):
                 f.write(data.get_object(oid))
                 f.flush()
 
-        with subprocess.Popen(
+        trace.count("subprocess.spawned")
+        with trace.span("subprocess.diff3"), subprocess.Popen(
             [
                 "diff3", "-m",
                 "-L", "HEAD", f_HEAD.name,
@@ -1,25 +1,75 @@
 import os
 
-from . import base, data
+from . import base, bitmap, data, trace
 
 REMOTE_REFS_BASE = "refs/heads/"
 LOCAL_REFS_BASE = "refs/remote/"
 
 
-def fetch(remote_path: str) -> None:
+@trace.traced("remote.fetch")
+def fetch(remote_path: str, depth: int = None, blob_limit: int = None) -> None:
     # Get refs from server
     refs = _get_remote_refs(remote_path, REMOTE_REFS_BASE)
+    remote = _open_remote(remote_path)
+    _match_chunk_threshold(remote, data.get_repository())
 
-    # Fetch missing objects by iterating and fetching on demand
-    for oid in base.iter_objects_in_commits(refs.values()):
+    # Having a commit means having its history (down to the shallow
+    # boundary in a shallow clone, which a fetch without depth keeps). With
+    # a depth, walk through the commits we have, as the history they have
+    # here may be shorter than asked for. The walk is short anyway.
+    local = data.get_repository()
+    if depth is not None:
+        has_commit = lambda oid: False
+    else:
+        has_commit = local.object_exists
+
+    # Walk the history on the server side, where it's complete (or as shallow
+    # as the server itself is), down to the commits we already have. Use the
+    # server's bitmaps if it has any (and they can answer the question).
+    with data.change_git_dir(remote_path):
+        found = None
+        if depth is None:
+            haves = [
+                ref.value for _, ref in local.iter_refs()
+                if remote.object_exists(ref.value)
+            ]
+            found = bitmap.find_objects(refs.values(), haves)
+        if found is not None:
+            commits, objects = found
+        else:
+            commits, common = base.get_missing_commits(refs.values(), has_commit, depth)
+            objects = list(base.iter_missing_objects(commits, common))
+
+    # Fetch missing objects, leaving large blobs on the server until they
+    # are needed
+    filtered = False
+    for oid in objects:
+        if data.object_exists(oid):
+            continue
+        if (
+            blob_limit is not None
+            and remote.object_size(oid) > blob_limit
+            and remote.object_type(oid) == "blob"
+        ):
+            filtered = True
+            continue
         data.fetch_object_if_missing(oid, remote_path)
 
+    if filtered:
+        data.set_promisor(os.path.abspath(remote_path))
+    _update_shallow(commits)
+
     # Update local refs to match server
-    for remote_name, value in refs.items():
-        refname = os.path.relpath(remote_name, REMOTE_REFS_BASE)
-        data.update_ref(f"{LOCAL_REFS_BASE}/{refname}", data.RefValue(symbolic=False, value=value))
-    
+    with data.ref_transaction() as transaction:
+        for remote_name, value in refs.items():
+            refname = os.path.relpath(remote_name, REMOTE_REFS_BASE)
+            transaction.update(
+                f"{LOCAL_REFS_BASE}/{refname}",
+                data.RefValue(symbolic=False, value=value),
+            )
 
+
+@trace.traced("remote.push")
 def push(remote_path: str, refname: str) -> None:
     # Get refs data
     remote_refs = _get_remote_refs(remote_path)
@@ -30,21 +80,70 @@ def push(remote_path: str, refname: str) -> None:
     # Don't allow force push
     assert not remote_ref or base.is_ancestor_of(local_ref, remote_ref)
 
-    # Compute which objects the serve doesn't have
-    known_remote_refs = filter(data.object_exists, remote_refs.values())
-    remote_objects = set(base.iter_objects_in_commits(known_remote_refs))
-    local_objects = set(base.iter_objects_in_commits({ local_ref }))
-    objects_to_push = local_objects - remote_objects
+    # Compute which objects the server doesn't have, with our bitmaps or by
+    # walking only the commits it lacks
+    remote = _open_remote(remote_path)
+    _match_chunk_threshold(data.get_repository(), remote)
+    haves = [oid for oid in remote_refs.values() if data.object_exists(oid)]
+    found = bitmap.find_objects({local_ref}, haves)
+    if found is not None:
+        commits, objects = found
+    else:
+        commits, common = base.get_missing_commits({local_ref}, remote.object_exists)
+        objects = base.iter_missing_objects(commits, common)
+
+    # History we send must be complete on the server, which it isn't if it
+    # reaches past the shallow boundary of this clone
+    if data.get_shallow():
+        sent = set(commits)
+        for oid in commits:
+            for parent in base.read_commit(oid).parents:
+                assert parent in sent or remote.object_exists(parent), (
+                    f"Shallow clone can't push {oid[:10]}: "
+                    f"the remote lacks its parent {parent[:10]}"
+                )
 
     # Push missing objects
-    for oid in objects_to_push:
-        data.push_object(oid, remote_path)
+    for oid in objects:
+        if not remote.object_exists(oid):
+            data.push_object(oid, remote_path)
 
-    # Update server ref to our value
-    with data.change_git_dir(remote_path):
-        data.update_ref(refname, data.RefValue(symbolic=False, value=local_ref))
+    # Update server ref to our value, unless someone else pushed meanwhile
+    remote.update_ref(
+        refname,
+        data.RefValue(symbolic=False, value=local_ref),
+        old=data.RefValue(symbolic=False, value=remote_ref),
+    )
 
 
-def _get_remote_refs(remote_path: str, prefix: str = "") -> None:
-    with data.change_git_dir(remote_path):
-        return {refname: ref.value for refname, ref in data.iter_refs(prefix)}
\ No newline at end of file
+def _update_shallow(fetched_commits: list[str]) -> None:
+    # A commit is shallow when we don't have all its parents. Fetching more
+    # history may complete commits that used to be shallow.
+    candidates = data.get_shallow() | set(fetched_commits)
+    shallow = {
+        oid for oid in candidates
+        if not all(data.object_exists(parent) for parent in base.read_commit(oid).parents)
+    }
+    if shallow != data.get_shallow():
+        data.set_shallow(shallow)
+
+
+def _match_chunk_threshold(source: data.Repository, target: data.Repository) -> None:
+    # The chunk threshold decides the oid of large files, so both sides must
+    # use the same one or the receiving side would see them as modified. A
+    # receiver without a threshold takes over the sender's.
+    if target.chunk_threshold is None and source.chunk_threshold is not None:
+        target.set_chunk_threshold(source.chunk_threshold)
+    assert source.chunk_threshold == target.chunk_threshold, (
+        f"Chunk thresholds differ: {source.git_dir} uses {source.chunk_threshold}, "
+        f"{target.git_dir} uses {target.chunk_threshold}"
+    )
+
+
+def _open_remote(remote_path: str) -> data.Repository:
+    return data.open_repository(f"{remote_path}/.ugit")
+
+
+def _get_remote_refs(remote_path: str, prefix: str = "") -> dict:
+    remote = _open_remote(remote_path)
+    return {refname: ref.value for refname, ref in remote.iter_refs(prefix)}
\ No newline at end of file
@@ -0,0 +1,126 @@
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+
+# Set by enable(). Everything below is a cheap no-op while it is False.
+enabled = False
+
+# Where report() writes: None for a summary on stderr, otherwise the path of
+# a Chrome trace (load it in chrome://tracing or https://ui.perfetto.dev)
+_output = None
+_start = None
+
+_lock = threading.Lock()
+_counters = Counter()
+_phases = {}
+_events = []
+
+_NULL_SPAN = nullcontext()
+
+
+def enable(output: str = None) -> None:
+    global enabled, _output, _start
+    enabled = True
+    _output = output
+    _start = time.perf_counter()
+
+
+def enable_from_env() -> None:
+    # UGIT_TRACE=1 prints a summary, any other value is a Chrome trace path
+    value = os.environ.get("UGIT_TRACE")
+    if not value or value.lower() in ("0", "false", "no"):
+        return
+    enable(None if value.lower() in ("1", "true", "yes") else value)
+
+
+def count(name: str, n: int = 1) -> None:
+    if not enabled:
+        return
+    with _lock:
+        _counters[name] += n
+
+
+def span(name: str):
+    if not enabled:
+        return _NULL_SPAN
+    return _span(name)
+
+
+def traced(name: str):
+    # Decorator form of span(), for plain (non-generator) functions
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            with _span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def _span(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        with _lock:
+            calls, total = _phases.get(name, (0, 0.0))
+            _phases[name] = (calls + 1, total + end - start)
+            _events.append((name, start, end, threading.get_ident()))
+
+
+def report() -> None:
+    if not enabled:
+        return
+    if _output:
+        _write_chrome_trace(_output)
+    else:
+        _write_summary(sys.stderr)
+
+
+def _write_summary(out) -> None:
+    elapsed = time.perf_counter() - _start
+    print(f"ugit trace: {elapsed * 1000:.2f} ms total", file=out)
+    if _phases:
+        print(f"\n{'phase':<32} {'calls':>8} {'ms':>10}", file=out)
+        for name, (calls, total) in sorted(
+            _phases.items(), key=lambda item: item[1][1], reverse=True
+        ):
+            print(f"{name:<32} {calls:>8} {total * 1000:>10.2f}", file=out)
+    if _counters:
+        print(f"\n{'counter':<32} {'value':>19}", file=out)
+        for name, value in sorted(_counters.items()):
+            print(f"{name:<32} {value:>19}", file=out)
+
+
+def _write_chrome_trace(path: str) -> None:
+    pid = os.getpid()
+    events = [
+        {
+            "name": name,
+            "ph": "X",
+            "ts": (start - _start) * 1e6,
+            "dur": (end - start) * 1e6,
+            "pid": pid,
+            "tid": tid,
+        }
+        for name, start, end, tid in _events
+    ]
+    events.append({
+        "name": "counters",
+        "ph": "C",
+        "ts": (time.perf_counter() - _start) * 1e6,
+        "pid": pid,
+        "args": dict(_counters),
+    })
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "otherData": {"counters": dict(_counters)}}, f)